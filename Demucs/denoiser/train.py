@@ -49,11 +49,15 @@ def run(args):
     # Building datasets and loaders
     tr_dataset = NoisyCleanSet(
         args.dset.train, length=length, stride=stride, pad=args.pad, **kwargs)
+    # pin_memory lets the solver overlap H2D copies with compute
+    # through non_blocking transfers.
     tr_loader = distrib.loader(
-        tr_dataset, batch_size=args.batch_size, shuffle=True, num_workers=args.num_workers)
+        tr_dataset, batch_size=args.batch_size, shuffle=True, num_workers=args.num_workers,
+        pin_memory=True)
     if args.dset.valid:
         cv_dataset = NoisyCleanSet(args.dset.valid, **kwargs)
-        cv_loader = distrib.loader(cv_dataset, batch_size=args.batch_size, num_workers=args.num_workers)
+        cv_loader = distrib.loader(cv_dataset, batch_size=args.batch_size,
+                                   num_workers=args.num_workers, pin_memory=True)
     else:
         cv_loader = None
     if args.dset.test:
@@ -17,6 +17,12 @@ class AcousticLoss(torch.nn.Module):
         """
         super(AcousticLoss, self).__init__()
         self.device       = device
+        self.nfft         = 512
+        self.hop_length   = 160
+        # Rectangular window with window length = 32ms, hop length = 10ms.
+        # Registered as a buffer so it lives on device and torch.stft does
+        # not allocate a fresh default window on every call.
+        self.register_buffer("stft_window", torch.ones(self.nfft, device=device))
         self.estimate_acoustics = AcousticEstimator()
         self.loss_type = loss_type
         if self.loss_type == "l2":
@@ -27,6 +33,13 @@ class AcousticLoss(torch.nn.Module):
         model_state_dict  = torch.load(acoustic_model_path, map_location=device)['model_state_dict']
         self.estimate_acoustics.load_state_dict(model_state_dict)
         self.estimate_acoustics.to(device)
+        # The estimator is a fixed reference network: freeze its parameters
+        # so no autograd graph is built for them. It stays in train mode
+        # because cuDNN only supports LSTM backward (needed for the enhanced
+        # pass, which takes gradients w.r.t. its input) in training mode,
+        # and with no dropout or batch norm the two modes compute the same.
+        for param in self.estimate_acoustics.parameters():
+            param.requires_grad_(False)
         
     def __call__(self, clean_waveform, enhan_waveform, mode="train"):
         return self.forward(clean_waveform, enhan_waveform, mode)
@@ -39,25 +52,25 @@ class AcousticLoss(torch.nn.Module):
                 Tensor of clean waveform with shape (B, T * sr).
             enhan_waveform (torch.FloatTensor)： 
                 Tensor of enhanced waveform with shape (B, T * sr).
-            mode (str) : 
-                'train' or 'eval'
+            mode (str) :
+                'train' or 'eval', kept for backward compatibility; the
+                estimator parameters are frozen either way.
         Returns:
             acoustic_loss (torch.FloatTensor):
                 Loss value corresponding to the selected loss type.
         """
-        
-        if   mode == "train":
-            self.estimate_acoustics.train()
-        elif mode == "eval":
-            self.estimate_acoustics.eval()     
-        else:
-            raise ValueError("Invalid mode, must be either 'train' or 'eval'.")
-            
-            
-        clean_spectrogram = self.get_stft(clean_waveform)
-        enhan_spectrogram, enhan_st_energy = self.get_stft(enhan_waveform, return_short_time_energy = True)
-        clean_acoustics   = self.estimate_acoustics(clean_spectrogram)
+
+        # Batch clean and enhanced together so one STFT and one estimator
+        # forward serve both, halving kernel launches.
+        both_waveform     = torch.cat([clean_waveform, enhan_waveform], dim = 0)
+        both_spectrogram, both_st_energy = self.get_stft(both_waveform, return_short_time_energy = True)
+        clean_spectrogram, enhan_spectrogram = both_spectrogram.chunk(2, dim = 0)
+        # Clean acoustics are only a target, so no gradient graph is needed
+        # for that estimator pass.
+        with torch.no_grad():
+            clean_acoustics = self.estimate_acoustics(clean_spectrogram)
         enhan_acoustics   = self.estimate_acoustics(enhan_spectrogram)
+        enhan_st_energy   = both_st_energy[clean_waveform.size(dim = 0):]
 
         """
         loss_type must be one of the following 4 options:
@@ -67,12 +80,15 @@ class AcousticLoss(torch.nn.Module):
             acoustic_loss   = self.l2(enhan_acoustics, clean_acoustics)
         elif self.loss_type == "l1":
             acoustic_loss   = self.l1(enhan_acoustics, clean_acoustics)
-        elif self.loss_type == "frame_energy_weighted_l2":
-            acoustic_loss   = torch.mean(((torch.sigmoid(enhan_st_energy)** 0.5).unsqueeze(dim = -1) \
-            * (enhan_acoustics - clean_acoustics)) ** 2 )                                       
-        elif self.loss_type == "frame_energy_weighted_l1":
-            acoustic_loss   = torch.mean(torch.sigmoid(enhan_st_energy).unsqueeze(dim = -1) \
-            * torch.abs(enhan_acoustics - clean_acoustics))
+        elif self.loss_type in ("frame_energy_weighted_l2", "frame_energy_weighted_l1"):
+            # sigmoid(E)**0.5 squared is just sigmoid(E), so both weighted
+            # losses share one sigmoid kernel and one difference tensor.
+            weight = torch.sigmoid(enhan_st_energy).unsqueeze(dim = -1)
+            diff   = enhan_acoustics - clean_acoustics
+            if self.loss_type == "frame_energy_weighted_l2":
+                acoustic_loss = torch.mean(weight * diff.pow(2))
+            else:
+                acoustic_loss = torch.mean(weight * diff.abs())
         else:
             raise ValueError("Invalid loss_type {}".format(self.loss_type))
     
@@ -93,18 +109,20 @@ class AcousticLoss(torch.nn.Module):
             st_energy (torch.FloatTensor):
                 Short-time energy calculated in the frequency domain using Parseval's theorem.  
         """
-        self.nfft       = 512
-        self.hop_length = 160
-        spec = torch.stft(wav, n_fft=self.nfft, hop_length=self.hop_length, return_complex=False) # Rectangular window with window length = 32ms, hop length = 10ms
-        spec_real = spec[..., 0]
-        spec_imag = spec[..., 1]     
-        spec = spec.permute(0, 2, 1, 3).reshape(spec.size(dim=0), -1,  2 * (self.nfft//2 + 1)) # spec ==> (B, T * sr, 2 * (nfft / 2 + 1))
+        spec_c = torch.stft(wav, n_fft=self.nfft, hop_length=self.hop_length,
+                            window=self.stft_window, return_complex=True)
+        # view_as_real on the transposed spec is a view, so the reshape below
+        # is the only copy. spec ==> (B, T, 2 * (nfft / 2 + 1))
+        spec = torch.view_as_real(spec_c.transpose(1, 2)) \
+                    .reshape(spec_c.size(dim=0), -1, 2 * (self.nfft//2 + 1))
 
         if return_short_time_energy:
-            st_energy = torch.mul(torch.sum(spec_real**2 + spec_imag**2, dim = 1), 2/self.nfft) 
-            return spec.float(), st_energy.float()
-        else: 
-            return spec.float()
+            # Parseval's theorem, computed on the complex spectrogram so no
+            # real/imag slices are materialized.
+            st_energy = spec_c.real.pow(2).add_(spec_c.imag.pow(2)).sum(dim=1).mul_(2.0 / self.nfft)
+            return spec, st_energy
+        else:
+            return spec
         
         
 